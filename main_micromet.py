@@ -8,6 +8,7 @@ Created on Mon Jun 30 14:08:03 2025
 import json
 import rasterio
 import xarray as xr
+import pandas as pd
 import os
 import datetime
 import sys
@@ -16,36 +17,60 @@ from get_era5_land import get_era5
 from utils import *
 from downscaling_variables import *
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from joblib import Parallel, delayed
-
-def run_month(curr_climate_file, dem_path, working_directory, variables_to_downscale, custom_lapse_rates, dem_nodata):
-    month = os.path.basename(curr_climate_file).split('_')[2]
-    year = os.path.basename(curr_climate_file).split('_')[1]
+import dask
+from dask.distributed import Client
+
+# ERA5-Land variables read by each downscaled variable
+CLIMATE_VARIABLES = {
+    "t_air": ["t2m"],
+    "sw_radiation": ["t2m", "d2m"],
+    "relative_humidity": ["t2m", "d2m"],
+    "precipitation": ["tp", "precip"],
+    "wind": ["u10", "v10"],
+}
+
+def run_month(climate_ds, year, month, terrain, working_directory, flags, lapse_rate_T, gamma_P):
+    month_tag = f"{year}_{month:02d}"
+    # Still lazy: the downscalers read the chunks time step by time step
+    time_dim = "valid_time" if "valid_time" in climate_ds.dims else "time"
+    month_ds = climate_ds.sel({time_dim: f"{year}-{month:02d}"})
+    tasks = []
 
     # Air Temperature
-    if parse_yes_no_flag(variables_to_downscale.get("t_air", "n"), "t_air"):
+    if flags.get("t_air", False):
         output_folder_T = os.path.join(working_directory, 'outputs', 'Temperature')
-        downscale_Temperature(dem_path, curr_climate_file, output_folder_T, custom_lapse_rates.get("temperature", {}).get("monthly"), dem_nodata=dem_nodata)
+        tasks.append(delayed(downscale_Temperature)(terrain, month_ds, output_folder_T, month_tag, lapse_rate_T))
 
     # Shortwave Radiation
-    if parse_yes_no_flag(variables_to_downscale.get("sw_radiation", "n"), "sw_radiation"):
+    if flags.get("sw_radiation", False):
         output_folder_SW = os.path.join(working_directory, 'outputs', 'SW')
-        downscale_SW(dem_path, curr_climate_file, output_folder_SW, z_700=3000, S0=1370.0, custom_lapse_rate=custom_lapse_rates.get("temperature", {}).get("monthly"), dem_nodata=dem_nodata)
+        tasks.append(delayed(downscale_SW)(terrain, month_ds, output_folder_SW, month_tag, z_700=3000, S0=1370.0, custom_lapse_rate=lapse_rate_T))
 
     # Relative Humidity
-    if parse_yes_no_flag(variables_to_downscale.get("relative_humidity", "n"), "relative_humidity"):
+    if flags.get("relative_humidity", False):
         output_folder_RH = os.path.join(working_directory, 'outputs', 'RH')
-        downscale_RH(dem_path, curr_climate_file, output_folder_RH, custom_lapse_rate=custom_lapse_rates.get("temperature", {}).get("monthly"), dem_nodata=dem_nodata)
+        tasks.append(delayed(downscale_RH)(terrain, month_ds, output_folder_RH, month_tag, custom_lapse_rate=lapse_rate_T))
 
     # Precipitation
-    if parse_yes_no_flag(variables_to_downscale.get("precipitation", "n"), "precipitation"):
+    if flags.get("precipitation", False):
         output_folder_P  = os.path.join(working_directory, 'outputs', 'P')
-        downscale_Precipitation(dem_path, curr_climate_file, output_folder_P, custom_gamma=custom_lapse_rates.get("precipitation", {}).get("monthly"), dem_nodata=dem_nodata)
+        tasks.append(delayed(downscale_Precipitation)(terrain, month_ds, output_folder_P, month_tag, custom_gamma=gamma_P))
         
      # Wind
-    if parse_yes_no_flag(variables_to_downscale.get("wind", "n"), "wind"):
+    if flags.get("wind", False):
         output_folder_W  = os.path.join(working_directory, 'outputs', 'Wind')
-        downscale_Wind(dem_path, curr_climate_file, output_folder_W, slope_weight=0.5, dem_nodata=dem_nodata)
+        tasks.append(delayed(downscale_Wind)(terrain, month_ds, output_folder_W, month_tag, slope_weight=0.5))
+
+    # Variables share the same terrain arrays and spend their time in NumPy/rasterio,
+    # which release the GIL, so threads are enough here. The climate chunks are
+    # small, so each thread reads them itself instead of submitting them back to
+    # the cluster from inside a task
+    if tasks:
+        with dask.config.set(scheduler="synchronous"):
+            Parallel(n_jobs=len(tasks), backend="threading")(tasks)
 
 
 def run_micropezzomet(config_path):
@@ -65,6 +90,12 @@ def run_micropezzomet(config_path):
     jobs_download = config["jobs_parallel_download"]
     dem_nodata = config.get("dem_nodata", None)
 
+    # GDAL cache and threading for large rasters (anything already set in the environment wins).
+    # Dask workers inherit these, so GDAL gets few threads when several workers run at once
+    os.environ.setdefault("GDAL_CACHEMAX", "1024")
+    os.environ.setdefault("GDAL_NUM_THREADS", "ALL_CPUS" if jobs_downscaling == 1 else "2")
+    os.environ.setdefault("GDAL_TIFF_INTERNAL_MASK", "YES")
+
     create_full_micromet_folder_structure(base_path=working_directory)
 
     if era_path is None:
@@ -81,17 +112,76 @@ def run_micropezzomet(config_path):
             aggregate_daily=aggregate_daily
         )
 
-    compute_slope_aspect(dem_path, working_directory)
-    
-    compute_topographic_curvature(dem_path, working_directory)
-
-    climate_files = sorted(glob.glob(os.path.join(working_directory, 'inputs/climate', '*.nc')))
+    # Validate the y/n flags once here rather than in every monthly task; only
+    # the variables that have a downscaler are read, any other key is ignored
     variables_to_downscale = config["variables_to_downscale"]
+    flags = {var_name: parse_yes_no_flag(variables_to_downscale.get(var_name, "n"), var_name)
+             for var_name in CLIMATE_VARIABLES}
+    if not any(flags.values()):
+        print("No variables enabled in 'variables_to_downscale', nothing to downscale.")
+        return
+
+    # Monthly custom lapse rates as (12,) arrays, converted once for all months
     custom_lapse_rates = config.get("custom_lapse_rates", {})
+    lapse_rate_T = parse_monthly_rates(custom_lapse_rates.get("temperature", {}).get("monthly"), "temperature")
+    gamma_P = parse_monthly_rates(custom_lapse_rates.get("precipitation", {}).get("monthly"), "precipitation")
+
+    # Only build the terrain derivatives an enabled variable uses (slope/aspect for
+    # shortwave, curvature for wind); they are independent, so GDAL runs in a
+    # background thread while the curvature is computed here. The Numba parallel
+    # kernel must stay on the main thread: launched from a worker thread with the
+    # TBB threading layer, the interpreter hangs on exit
+    slope_path = aspect_path = curvature_path = None
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        slope_aspect_job = executor.submit(compute_slope_aspect, dem_path, working_directory) if flags.get("sw_radiation", False) else None
+
+        if flags.get("wind", False):
+            curvature_path = compute_topographic_curvature(dem_path, working_directory)
+        if slope_aspect_job is not None:
+            slope_path, aspect_path = slope_aspect_job.result()
+
+    # Read the terrain once and share it with all the downscaling tasks
+    terrain = load_terrain(dem_path, slope_path, aspect_path, curvature_path, dem_nodata=dem_nodata)
+
+    climate_files = sorted(glob.glob(os.path.join(working_directory, 'inputs/climate', '*.nc')))
 
-    Parallel(n_jobs=jobs_downscaling)(
-        delayed(run_month)(f, dem_path, working_directory, variables_to_downscale, custom_lapse_rates, dem_nodata) for f in climate_files
+    if not climate_files:
+        print("No climate files found, nothing to downscale.")
+        return
+
+    # One lazy, chunked view over all climate files
+    climate_ds = xr.open_mfdataset(
+        climate_files,
+        chunks={"valid_time": 24, "time": 24, "latitude": 128, "longitude": 128},
+        parallel=True,
+        combine="by_coords",
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+        engine="h5netcdf"
     )
+    time_dim = "valid_time" if "valid_time" in climate_ds.dims else "time"
+    months = pd.DatetimeIndex(climate_ds[time_dim].values).to_period("M").unique()
+
+    # Keep only the climate variables the enabled downscalers read
+    needed = {var for flag, var_names in CLIMATE_VARIABLES.items() if flags.get(flag, False) for var in var_names}
+    climate_ds = climate_ds[[var for var in climate_ds.data_vars if var in needed]]
+
+    # Same convention as joblib's n_jobs: -1 means all CPUs, -2 all but one, ...
+    n_workers = jobs_downscaling if jobs_downscaling > 0 else max(1, os.cpu_count() + 1 + jobs_downscaling)
+
+    with Client(n_workers=n_workers, threads_per_worker=1) as client:
+        # Send the terrain to every worker once instead of serializing it into each task
+        [terrain_future] = client.scatter([terrain], broadcast=True)
+
+        # Bound through partial so dask does not treat the lazy dataset as an argument
+        # to compute up front: each task slices its month and reads chunks as it goes
+        run_month_lazy = dask.delayed(partial(run_month, climate_ds), traverse=False)
+        tasks = [
+            run_month_lazy(month.year, month.month, terrain_future, working_directory, flags, lapse_rate_T, gamma_P)
+            for month in months
+        ]
+        dask.compute(*tasks)
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
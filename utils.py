@@ -8,10 +8,32 @@ Created on Mon Jun 30 14:20:57 2025
 
 import json
 import rasterio
+from rasterio.windows import Window
+from osgeo import gdal
 import xarray as xr
+import rioxarray  # noqa: F401  (registers the .rio accessor)
+import h5netcdf.legacyapi
 import os
 import numpy as np
 import pandas as pd
+from numba import njit, prange
+
+
+# Tiled, compressed GeoTIFF layout for the rasters written once by GDAL
+# (float32 data, hence the floating-point predictor)
+GTIFF_PROFILE = {
+    "driver": "GTiff",
+    "tiled": True,
+    "blockxsize": 512,
+    "blockysize": 512,
+    "compress": "DEFLATE",
+    "predictor": 3,
+    "num_threads": "ALL_CPUS",
+    "BIGTIFF": "IF_SAFER",
+}
+
+# fastmath without 'nnan'/'ninf' so the NaN checks on no-data cells are kept
+_FASTMATH = {"nsz", "arcp", "contract", "afn", "reassoc"}
 
 
 def parse_yes_no_flag(value, var_name=""):
@@ -36,6 +58,29 @@ def parse_yes_no_flag(value, var_name=""):
         raise ValueError(f"Invalid value for '{var_name}': {value}. Expected 'y' or 'n'.")
 
 
+def parse_monthly_rates(values, var_name=""):
+    """
+    Converts the 12 monthly rates of the config (per km) to an array (per m).
+
+    Parameters:
+        values (list or None): Monthly rates, January to December, or None for the defaults.
+        var_name (str): Optional variable name for clearer error messages.
+
+    Returns:
+        np.ndarray or None: float32 array of shape (12,), or None if values is None.
+
+    Raises:
+        ValueError: If values does not hold exactly 12 numbers.
+    """
+    if values is None:
+        return None
+
+    rates = np.asarray(values, dtype=np.float32)
+    if rates.shape != (12,):
+        raise ValueError(f"Invalid monthly rates for '{var_name}': expected 12 values, got {rates.size}.")
+    return rates / np.float32(1000.0)
+
+
 def create_full_micromet_folder_structure(base_path="."):
     folders = [
         "inputs/climate",
@@ -62,20 +107,102 @@ def load_dem(dem_path):
         dem_transform = src.transform
     return dem_data, dem_meta, dem_transform
 
-def load_era_data(era_path, variables, start_date=None, end_date=None):
-    era_ds = xr.open_dataset(era_path)
+def _tile_windows(height, width, tile_size):
+    for row_off in range(0, height, tile_size):
+        for col_off in range(0, width, tile_size):
+            yield Window(col_off, row_off,
+                         min(tile_size, width - col_off),
+                         min(tile_size, height - row_off))
+
+def load_dem_windowed(dem_path, tile_size=2048, overlap=0):
+    """
+    Read a DEM tile by tile instead of loading it whole.
+
+    Parameters:
+        dem_path (str): Path to the input DEM file.
+        tile_size (int): Tile edge length (pixels).
+        overlap (int): Extra cells read on each side of the tile (clipped at the DEM edges).
+
+    Yields:
+        window (Window): The tile, without overlap.
+        data (ndarray): The tile grown by `overlap`; the tile itself starts at
+            row min(overlap, window.row_off), column min(overlap, window.col_off).
+        transform (Affine): Transform of `data`.
+    """
+    with rasterio.open(dem_path, sharing=False) as src:
+        for window in _tile_windows(src.height, src.width, tile_size):
+            row_start = max(0, window.row_off - overlap)
+            col_start = max(0, window.col_off - overlap)
+            row_stop = min(src.height, window.row_off + window.height + overlap)
+            col_stop = min(src.width, window.col_off + window.width + overlap)
+            read_window = Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+            yield window, src.read(1, window=read_window), src.window_transform(read_window)
+
+def load_terrain(dem_path, slope_path=None, aspect_path=None, curvature_path=None, dem_nodata=None):
+    """
+    Load the DEM and its derived rasters once, so they can be shared by every
+    downscaling task instead of being re-read for each month and variable.
+
+    Parameters:
+        dem_path (str): Path to the input DEM file.
+        slope_path (str): Optional path to the slope raster (degrees).
+        aspect_path (str): Optional path to the aspect raster (degrees).
+        curvature_path (str): Optional path to the curvature raster.
+        dem_nodata (float or int): No-data value in DEM
+
+    Returns:
+        dict: dem, dem_mask, dem_crs, dem_transform, slope_rad, aspect_rad and curvature
+        (None for the rasters whose path was not given).
+    """
+    dem, dem_meta, dem_transform = load_dem(dem_path)
+
+    terrain = {
+        "dem": dem,
+        "dem_mask": (dem == dem_nodata) if dem_nodata is not None else np.isnan(dem),
+        "dem_crs": dem_meta["crs"],
+        "dem_transform": dem_transform,
+        "slope_rad": None,
+        "aspect_rad": None,
+        "curvature": None,
+    }
+
+    if slope_path is not None:
+        with rasterio.open(slope_path) as slope_src:
+            terrain["slope_rad"] = np.radians(slope_src.read(1))
+    if aspect_path is not None:
+        with rasterio.open(aspect_path) as aspect_src:
+            terrain["aspect_rad"] = np.radians(aspect_src.read(1))
+    if curvature_path is not None:
+        with rasterio.open(curvature_path) as curv_src:
+            terrain["curvature"] = curv_src.read(1)
+
+    return terrain
 
-    # Optionally select variables and time range
-    era_ds = era_ds[variables]
+def load_era_data(era_path, variables, start_date=None, end_date=None):
+    # Open lazily and without CF decoding, so scale/offset and masking are only
+    # applied to the selected variables, and only to the chunks that get read
+    era_ds = xr.open_dataset(era_path, engine="h5netcdf", chunks={"valid_time": 24, "time": 24},
+                             decode_cf=False)
+
+    # Optionally select variables and time range (the time slice needs decoded times).
+    # A single name is wrapped in a list so decode_cf always gets a Dataset
+    era_ds = era_ds[[variables]] if isinstance(variables, str) else era_ds[variables]
+    era_ds = xr.decode_cf(era_ds)
     if start_date and end_date and "time" in era_ds.dims:
         era_ds = era_ds.sel(time=slice(start_date, end_date))
 
     return era_ds
 
 
+def _is_up_to_date(output_path, source_path):
+    """True if output_path exists and is not older than source_path."""
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(source_path)
+
+
 def compute_slope_aspect(dem_path, working_directory):
     """
-    Compute slope and aspect from a DEM using gdaldem and save results to <working_directory>/input/dem.
+    Compute slope and aspect from a DEM using GDAL's DEMProcessing and save results to <working_directory>/input/dem.
 
     Parameters:
         dem_path (str): Path to the input DEM file.
@@ -91,32 +218,109 @@ def compute_slope_aspect(dem_path, working_directory):
     slope_path = os.path.join(output_dir, 'slope.tif')
     aspect_path = os.path.join(output_dir, 'aspect.tif')
 
-    # Build and run gdaldem commands
-    slope_cmd = f'gdaldem slope "{dem_path}" "{slope_path}" -of GTiff'
-    aspect_cmd = f'gdaldem aspect "{dem_path}" "{aspect_path}" -of GTiff'
-
-    slope_status = os.system(slope_cmd)
-    aspect_status = os.system(aspect_cmd)
-
-    if slope_status == 0 and aspect_status == 0:
+    if _is_up_to_date(slope_path, dem_path) and _is_up_to_date(aspect_path, dem_path):
+        print(f"Slope and aspect already up to date in {output_dir}. Skipping.")
+        return slope_path, aspect_path
+
+    # Same tiled, compressed layout as the other raster outputs
+    creation_options = [f"{key.upper()}={'YES' if value is True else value}"
+                        for key, value in GTIFF_PROFILE.items() if key != "driver"]
+
+    # Run gdaldem in-process, reusing the same DEM handle for both products.
+    # Write under temporary names so a failed run never leaves outputs that look up to date
+    tmp_slope_path = slope_path + ".part"
+    tmp_aspect_path = aspect_path + ".part"
+    src = gdal.Open(dem_path)
+    slope_ds = gdal.DEMProcessing(tmp_slope_path, src, "slope", format="GTiff",
+                                  computeEdges=False, creationOptions=creation_options)
+    aspect_ds = gdal.DEMProcessing(tmp_aspect_path, src, "aspect", format="GTiff",
+                                   computeEdges=False, creationOptions=creation_options)
+    success = slope_ds is not None and aspect_ds is not None
+
+    # Dropping the references flushes and closes the GDAL datasets
+    slope_ds = aspect_ds = src = None
+
+    if success:
+        os.replace(tmp_slope_path, slope_path)
+        os.replace(tmp_aspect_path, aspect_path)
         print(f"Slope and aspect successfully saved in {output_dir}")
     else:
-        print("Error running gdaldem commands")
+        for tmp_path in (tmp_slope_path, tmp_aspect_path):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        print("Error running gdal.DEMProcessing")
 
     return slope_path, aspect_path
 
 
 
-def compute_topographic_curvature(dem_path, working_directory, L=1000, dem_nodata=None):
+def _curvature_weights(inc, deltaxy):
+    """
+    3x3 MicroMet curvature stencil (Liston and Elder, 2006), applied to
+    neighbours `inc` cells apart: diagonal terms are scaled by 1/sqrt(2).
     """
-    Compute and save curvature from DEM using vectorized numpy operations (fast version),
-    masking out no-data values.
+    diag = -1.0 / (np.sqrt(2.0) * 16.0 * inc * deltaxy)
+    cross = -1.0 / (16.0 * inc * deltaxy)
+    center = -4.0 * (diag + cross)
+    return np.array([[diag, cross, diag],
+                     [cross, center, cross],
+                     [diag, cross, diag]], dtype=np.float32)
+
+
+@njit(parallel=True, nogil=True, fastmath=_FASTMATH, cache=True)
+def _curvature_kernel(dem, inc, weights, top, left, row_off, col_off, height, width, out):
+    """
+    Convolve the tile `dem` with the dilated 3x3 `weights` stencil and return the
+    maximum of |curvature| over the valid cells (0 if there are none).
+    `out` receives the tile core, which starts at (top, left) in `dem` and at
+    (row_off, col_off) in the (height, width) DEM. Neighbour indices are clamped
+    to the DEM edges, which matches padding the DEM with its edge values without
+    making a padded copy; the tile overlap must cover the stencil inside the DEM.
+    """
+    ny, nx = out.shape
+    tile_row0 = row_off - top
+    tile_col0 = col_off - left
+    row_max = np.zeros(ny, dtype=np.float32)
+
+    for oi in prange(ny):
+        i = top + oi
+        gi = row_off + oi
+        m = np.float32(0.0)
+        for oj in range(nx):
+            j = left + oj
+            if np.isnan(dem[i, j]):
+                out[oi, oj] = np.nan
+                continue
+
+            gj = col_off + oj
+            c = np.float32(0.0)
+            for di in range(3):
+                ni = min(max(gi + (di - 1) * inc, 0), height - 1) - tile_row0
+                for dj in range(3):
+                    nj = min(max(gj + (dj - 1) * inc, 0), width - 1) - tile_col0
+                    c += weights[di, dj] * dem[ni, nj]
+            out[oi, oj] = c
+
+            # NaN neighbours give c = NaN, which never compares greater
+            if abs(c) > m:
+                m = abs(c)
+        row_max[oi] = m
+
+    return row_max.max()
+
+
+def compute_topographic_curvature(dem_path, working_directory, L=1000, dem_nodata=None, tile_size=2048):
+    """
+    Compute and save curvature from DEM using a Numba-compiled stencil,
+    masking out no-data values. The DEM is processed in tiles, so peak memory
+    is bounded by the tile size rather than the DEM size.
 
     Parameters:
         dem_path (str): Path to input DEM file
         working_directory (str): Output folder
         L (float): Curvature length scale (m)
         dem_nodata (float or int): No-data value in DEM
+        tile_size (int): Tile edge length (pixels)
 
     Returns:
         curvature_path (str): Path to saved curvature GeoTIFF
@@ -125,61 +329,50 @@ def compute_topographic_curvature(dem_path, working_directory, L=1000, dem_nodat
     os.makedirs(output_dir, exist_ok=True)
     curvature_path = os.path.join(output_dir, 'curvature.tif')
 
-    if os.path.exists(curvature_path):
-        print(f"Curvature already exists at {curvature_path}. Skipping.")
+    if _is_up_to_date(curvature_path, dem_path):
+        print(f"Curvature already up to date at {curvature_path}. Skipping.")
         return curvature_path
 
     with rasterio.open(dem_path) as src:
-        dem = src.read(1).astype(np.float32)
         transform = src.transform
         dem_meta = src.meta.copy()
 
-    if dem_nodata is not None:
-        dem[dem == dem_nodata] = np.nan
-
-    ny, nx = dem.shape
     deltax = transform.a
     deltay = -transform.e
     deltaxy = 0.5 * (deltax + deltay)
     inc = max(1, int(round(L / deltaxy)))
+    weights = _curvature_weights(inc, deltaxy)
 
-    dem_pad = np.pad(dem, inc, mode='edge')
-
-    # Prepare shifted arrays
-    z = dem_pad[inc:-inc, inc:-inc]
-    zW = dem_pad[inc:-inc, inc - inc:-2 * inc]
-    zE = dem_pad[inc:-inc, inc + inc:2 * inc + inc]
-    zS = dem_pad[inc + inc:2 * inc + inc, inc:-inc]
-    zN = dem_pad[inc - inc:-2 * inc, inc:-inc]
-    zSW = dem_pad[inc + inc:2 * inc + inc, inc - inc:-2 * inc]
-    zNE = dem_pad[inc - inc:-2 * inc, inc + inc:2 * inc + inc]
-    zNW = dem_pad[inc - inc:-2 * inc, inc - inc:-2 * inc]
-    zSE = dem_pad[inc + inc:2 * inc + inc, inc + inc:2 * inc + inc]
-
-    # Align shapes
-    common_shape = np.min([arr.shape for arr in [z, zW, zE, zS, zN, zSW, zNE, zNW, zSE]], axis=0)
-    def crop(arr): return arr[:common_shape[0], :common_shape[1]]
-    z, zW, zE, zS, zN = map(crop, [z, zW, zE, zS, zN])
-    zSW, zNE, zNW, zSE = map(crop, [zSW, zNE, zNW, zSE])
-
-    # Compute curvature
-    c_diag = (4 * z - zSW - zNE - zNW - zSE) / (np.sqrt(2.0) * 16.0 * inc * deltaxy)
-    c_cross = (4 * z - zW - zE - zN - zS) / (16.0 * inc * deltaxy)
-    curvature = c_diag + c_cross
-
-    curvature[np.isnan(z)] = np.nan
-
-    curve_max = max(0.001, np.nanmax(np.abs(curvature)))
-    curvature /= (2.0 * curve_max)
-
-    # Embed curvature into full DEM shape
-    full_curv = np.full_like(dem, np.nan, dtype=np.float32)
-    valid_shape = curvature.shape
-    full_curv[inc:inc + valid_shape[0], inc:inc + valid_shape[1]] = curvature
-
+    # First pass: curvature tile by tile (tiles overlap by inc so the stencil is
+    # complete at the seams), keeping track of the global max |curvature|.
+    # Written under a temporary name so an interrupted run is not reused
+    curve_max = 0.001
     dem_meta.update(dtype='float32', count=1)
-    with rasterio.open(curvature_path, 'w', **dem_meta) as dst:
-        dst.write(full_curv, 1)
+    tmp_path = curvature_path + ".part"
+    with rasterio.open(tmp_path, 'w', **dem_meta) as dst:
+        for window, dem, _ in load_dem_windowed(dem_path, tile_size=tile_size, overlap=inc):
+            dem = dem.astype(np.float32, copy=False)
+            if dem_nodata is not None:
+                dem[dem == dem_nodata] = np.nan
+
+            top = min(inc, window.row_off)
+            left = min(inc, window.col_off)
+            tile_curv = np.empty((window.height, window.width), dtype=np.float32)
+            curve_max = max(curve_max, _curvature_kernel(dem, inc, weights, top, left,
+                                                         window.row_off, window.col_off,
+                                                         dem_meta['height'], dem_meta['width'],
+                                                         tile_curv))
+            dst.write(tile_curv, 1, window=window)
+
+    # Second pass: normalization depends on the global max, so rescale in place
+    scale = np.float32(1.0 / (2.0 * curve_max))
+    with rasterio.open(tmp_path, 'r+') as dst:
+        for window in _tile_windows(dst.height, dst.width, tile_size):
+            tile_curv = dst.read(1, window=window)
+            tile_curv *= scale
+            dst.write(tile_curv, 1, window=window)
+
+    os.replace(tmp_path, curvature_path)
 
     print(f"Curvature saved to {curvature_path}")
     return curvature_path
@@ -188,6 +381,7 @@ def compute_topographic_curvature(dem_path, working_directory, L=1000, dem_nodat
 def write_downscaled_to_netcdf(
     variables_dict,
     time_list,
+    steps,
     dem_shape,
     dem_transform,
     dem_crs,
@@ -195,10 +389,13 @@ def write_downscaled_to_netcdf(
 ):
     """
     Save multiple downscaled variables to NetCDF with spatial referencing.
+    Time steps are written as they are produced, one time chunk at a time,
+    so the full (time, y, x) stack is never held in memory.
 
     Parameters:
-        variables_dict: dict of {var_name: (data_list, units, description)}
+        variables_dict: dict of {var_name: (units, description)}
         time_list: list of datetime objects
+        steps: iterable of (time_index, {var_name: 2D array}), in time order
         dem_shape: shape of the DEM used as reference
         dem_transform: Affine transform of the DEM
         dem_crs: CRS of the DEM
@@ -209,30 +406,45 @@ def write_downscaled_to_netcdf(
     x_coords = np.arange(width) * dem_transform.a + dem_transform.c + dem_transform.a / 2
     y_coords = np.arange(height) * dem_transform.e + dem_transform.f + dem_transform.e / 2
 
-    dataset_vars = {}
-
-    for var_name, (data_list, units, description) in variables_dict.items():
-        data_stack = np.concatenate(data_list, axis=0)
-
-        da = xr.DataArray(
-            data_stack,
-            dims=["time", "y", "x"],
-            coords={"time": time_list, "y": y_coords, "x": x_coords},
-            attrs={"units": units, "description": description}
-        )
-
-        dataset_vars[var_name] = da
-
-    ds_out = xr.Dataset(dataset_vars)
+    # Skeleton with coordinates and spatial reference only; data is appended below
+    ds_out = xr.Dataset(coords={"time": time_list, "y": y_coords, "x": x_coords})
     ds_out = ds_out.rio.write_transform(dem_transform)
     ds_out = ds_out.rio.write_crs(dem_crs)
 
     os.makedirs(os.path.dirname(out_nc), exist_ok=True)
-    ds_out.to_netcdf(out_nc)
+    # Write under a temporary name so an interrupted run is not mistaken for a finished one
+    tmp_nc = out_nc + ".part"
+    ds_out.to_netcdf(tmp_nc, engine="h5netcdf")
+
+    # Compressed, chunked storage: much smaller files and fast time-slice reads
+    chunksizes = (min(24, len(time_list)), min(512, height), min(512, width))
+    buffers = {var_name: [] for var_name in variables_dict}
+
+    with h5netcdf.legacyapi.Dataset(tmp_nc, "a") as nc:
+        for var_name, (units, description) in variables_dict.items():
+            var = nc.createVariable(var_name, "f4", ("time", "y", "x"),
+                                    zlib=True, complevel=4, chunksizes=chunksizes, fill_value=np.nan)
+            var.attrs["units"] = units
+            var.attrs["description"] = description
+            var.attrs["grid_mapping"] = "spatial_ref"
+            var.attrs["coordinates"] = "spatial_ref"
+
+        # Buffer a full time chunk so each compressed chunk is written only once
+        t_start = 0
+        for t, step in steps:
+            for var_name, data in step.items():
+                buffers[var_name].append(data)
+
+            if t + 1 - t_start == chunksizes[0]:
+                for var_name, block in buffers.items():
+                    nc[var_name][t_start:t + 1] = np.stack(block)
+                    block.clear()
+                t_start = t + 1
+
+        for var_name, block in buffers.items():
+            if block:
+                nc[var_name][t_start:t_start + len(block)] = np.stack(block)
+
+    os.replace(tmp_nc, out_nc)
 
     print(f"\nSaved NetCDF: {out_nc}")
-
-
-
-
-